@@ -1,19 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Date, DECIMAL, TIMESTAMP, Text, func, desc
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Date, DECIMAL, TIMESTAMP, Text, func, desc, text, select, tuple_
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from typing import List, Optional, Literal
+from typing import Callable, List, Optional, Literal
 import os
+import json
+import math
+import re
+import unicodedata
+import base64
+import csv
+import io
+import hashlib
+import threading
+import time
+import asyncio
+import httpx
+import numpy as np
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import date, datetime, timedelta
-import chromadb
-from sentence_transformers import SentenceTransformer
-import openai
-import anthropic
+import gc
+import glob
 import requests
-import google.generativeai as genai
 
 # Settings
 class Settings(BaseSettings):
@@ -24,34 +43,382 @@ class Settings(BaseSettings):
     GOOGLE_API_KEY: Optional[str] = None
     OPENAI_API_KEY: Optional[str] = None
     ANTHROPIC_API_KEY: Optional[str] = None
+    # KPIs desde transaction_monthly_rollups (mantenida por el ETL) en vez de escanear transactions
+    KPI_FROM_ROLLUPS: bool = True
+    # Cache de resultados de /analytics/*: TTL, cada cuánto se consulta la versión de datos
+    # (último pipeline_runs exitoso) y Redis opcional para compartirlo entre workers
+    RESULT_CACHE_TTL_SECONDS: int = 300
+    DATA_VERSION_CHECK_SECONDS: float = 5.0
+    REDIS_URL: Optional[str] = None
+    # Filas por lote del cursor de servidor en /transactions/export
+    EXPORT_BATCH_SIZE: int = 5000
+    # Pool de conexiones a PostgreSQL (dimensionar: workers × (pool_size + max_overflow) < max_connections)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # statement_timeout por conexión (ms, 0 = sin límite); el export usa el suyo propio
+    DB_STATEMENT_TIMEOUT_MS: int = 15000
+    EXPORT_STATEMENT_TIMEOUT_MS: int = 0
+    # Clientes LLM (uno por proveedor, compartido): timeout, reintentos, pool keep-alive y concurrencia
+    LLM_TIMEOUT_SECONDS: float = 60.0
+    LLM_MAX_RETRIES: int = 2
+    LLM_MAX_CONNECTIONS: int = 20
+    LLM_MAX_CONCURRENCY: int = 8
+    # Cache semántico de /llm/ask_rag: similitud coseno mínima entre preguntas, tamaño (LRU) y TTL
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 1000
+    SEMANTIC_CACHE_TTL_SECONDS: int = 3600
+    # Recuperación híbrida: candidatos del vector store, documentos finales y peso del vector vs BM25
+    RAG_CANDIDATES: int = 30
+    RAG_TOP_K: int = 5
+    RAG_HYBRID_ALPHA: float = 0.7
+    # Micro-batching de embeddings: encode concurrentes se agrupan en un solo forward pass
+    EMBEDDING_BATCHING_ENABLED: bool = True
+    EMBEDDING_BATCH_MAX_SIZE: int = 32
+    EMBEDDING_BATCH_MAX_WAIT_MS: float = 5.0
+    # Backend de embeddings (misma variable que el ETL): "torch", "onnx" u "onnx-int8"
+    EMBEDDING_BACKEND: str = "torch"
+    EMBEDDING_THREADS: int = 0
+    EMBEDDING_ONNX_INT8_FILE: str = "onnx/model_quint8_avx2.onnx"
+    # Vector store para RAG: "chroma" (servidor HTTP) o "embedded" (directorio que escribe el ETL)
+    VECTOR_STORE: str = "chroma"
+    # Mismo default que el ETL: <repo>/.vector_store (en docker ambos montan /vector_store)
+    VECTOR_STORE_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".vector_store")
+    # Cada cuánto se miran commits nuevos del ETL (la recarga es incremental y en segundo plano)
+    VECTOR_STORE_REFRESH_SECONDS: float = 5.0
+    # Store embebido: con filtros que dejan hasta estas filas se busca exacto; con más, HNSW filtrado
+    VECTOR_STORE_EXACT_MAX_ROWS: int = 20000
+    # Carga el modelo de embeddings al importar (gunicorn --preload: los workers comparten sus páginas)
+    PRELOAD_MODELS: bool = False
     
     class Config:
         env_file = ".env"
 
 settings = Settings()
 
-# Configure Gemini if API key is provided
-if settings.GOOGLE_API_KEY:
-    genai.configure(api_key=settings.GOOGLE_API_KEY)
+class LazyResource:
+    """Heavy object (model, client, SDK) built on first use; thread-safe, once per process."""
+    
+    def __init__(self, name: str, factory: Callable[[], object]):
+        self.name = name
+        self.factory = factory
+        self.load_seconds = None
+        self._value = None
+        self._lock = threading.Lock()
+    
+    @property
+    def loaded(self) -> bool:
+        return self._value is not None
+    
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    start = time.perf_counter()
+                    self._value = self.factory()
+                    self.load_seconds = round(time.perf_counter() - start, 3)
+        return self._value
 
 # Database setup (PostgreSQL solo para datos estructurados)
-engine = create_engine(settings.DATABASE_URL)
+class PoolStats:
+    """Checkout wait times and timeouts of the connection pool."""
+    
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+    
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+    
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return conn
+
+engine = create_engine(
+    settings.DATABASE_URL,
+    poolclass=TimedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    connect_args={"options": f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}"}
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# ChromaDB setup
-chroma_client = chromadb.HttpClient(host=settings.CHROMA_HOST, port=settings.CHROMA_PORT)
-try:
-    collection = chroma_client.get_or_create_collection(
+# ChromaDB setup (se conecta en el primer uso; si falla se reintenta en la siguiente petición)
+def connect_chroma_collection():
+    import chromadb
+    chroma_client = chromadb.HttpClient(host=settings.CHROMA_HOST, port=settings.CHROMA_PORT)
+    return chroma_client.get_or_create_collection(
         name="transactions",
         metadata={"description": "Financial transactions embeddings"}
     )
-except Exception as e:
-    print(f"Warning: Could not connect to ChromaDB: {e}")
-    collection = None
+
+chroma_collection = LazyResource("chromadb", connect_chroma_collection)
+
+def get_collection():
+    try:
+        return chroma_collection.get()
+    except Exception as e:
+        print(f"Warning: Could not connect to ChromaDB: {e}")
+        return None
+
+class ChromaVectorStore:
+    """RAG retrieval through the ChromaDB HTTP server."""
+    
+    name = "chroma"
+    
+    def available(self) -> bool:
+        return get_collection() is not None
+    
+    def query(self, embedding: List[float], n_results: int, where: Optional[dict] = None) -> dict:
+        return get_collection().query(query_embeddings=[embedding], n_results=n_results, where=where)
+    
+    def stats(self) -> dict:
+        # Sin conectar: /health no debe abrir (ni esperar) la conexión a Chroma, que es lazy
+        return {"backend": self.name, "status": "connected" if chroma_collection.loaded else "disconnected"}
+
+class EmbeddedVectorStore:
+    """In-process RAG retrieval over the directory the ETL writes (EmbeddedVectorStore en etl/flows.py).
+    
+    vectors.f32 se lee por memmap, la metadata (parquet) queda en memoria para filtrar y
+    index.hnsw resuelve las búsquedas (con filter= cuando el filtro deja muchas filas; si deja
+    pocas, búsqueda exacta sobre ellas). Solo cuentan las filas del manifest. Los
+    commits nuevos se recogen en segundo plano y de forma incremental: solo las partes de
+    metadata nuevas, y el índice solo cuando el ETL lo vuelve a guardar (las filas que aún
+    no cubre se buscan de forma exacta).
+    """
+    
+    name = "embedded"
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.manifest_mtime = None
+        self.index_mtime = None
+        self.checked_at = 0.0
+        self.reloading = False
+        # (rows, matrix, metadata, index): se reemplaza entero para que una consulta nunca mezcle versiones
+        self.snapshot = (0, None, None, None)
+    
+    def _refresh(self):
+        """Síncrono solo en la primera carga; después a lo sumo cada VECTOR_STORE_REFRESH_SECONDS y fuera de la petición."""
+        loaded = self.snapshot[1] is not None
+        now = time.monotonic()
+        if loaded and now - self.checked_at < settings.VECTOR_STORE_REFRESH_SECONDS:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(os.path.join(self.directory, "manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        if not loaded:
+            self._reload()
+        elif not self.reloading:
+            self.reloading = True
+            threading.Thread(target=self._reload, daemon=True).start()
+    
+    def _reload(self):
+        with self.lock:
+            try:
+                import polars as pl
+                manifest_path = os.path.join(self.directory, "manifest.json")
+                mtime = os.stat(manifest_path).st_mtime_ns
+                if mtime == self.manifest_mtime:
+                    return
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                rows, dim = manifest["rows"], manifest["dim"]
+                previous_rows, _, metadata, index = self.snapshot
+                if rows < previous_rows:
+                    previous_rows, metadata, index, self.index_mtime = 0, None, None, None  # store regenerado
+                
+                matrix = np.empty((0, dim), dtype=np.float32)
+                if rows:
+                    matrix = np.memmap(os.path.join(self.directory, "vectors.f32"), dtype=np.float32, mode="r", shape=(rows, dim))
+                # Solo las partes nuevas: cada parte se llama por la fila en la que empieza
+                new_parts = [
+                    path for path in sorted(glob.glob(os.path.join(self.directory, "meta", "part-*.parquet")))
+                    if previous_rows <= int(os.path.basename(path)[len("part-"):-len(".parquet")]) < rows
+                ]
+                frames = ([metadata] if metadata is not None else []) + [pl.read_parquet(path) for path in new_parts]
+                if frames:
+                    metadata = pl.concat(frames, how="vertical_relaxed").filter(pl.col("row") < rows)
+                
+                self.snapshot = (rows, matrix, metadata, self._load_index(dim, index))
+                self.manifest_mtime = mtime
+            finally:
+                self.reloading = False
+    
+    def _load_index(self, dim: int, current):
+        """Reload index.hnsw only when the ETL saved it again; si no, se conserva el actual."""
+        index_path = os.path.join(self.directory, "index.hnsw")
+        try:
+            import hnswlib
+            mtime = os.stat(index_path).st_mtime_ns
+        except (ImportError, FileNotFoundError):
+            return current
+        if mtime == self.index_mtime:
+            return current
+        index = hnswlib.Index(space="l2", dim=dim)
+        index.load_index(index_path)
+        index.set_ef(max(2 * settings.RAG_CANDIDATES, 64))
+        self.index_mtime = mtime
+        return index if index.get_current_count() else None
+    
+    @staticmethod
+    def where_expr(where: dict):
+        """Chroma `where` clause ($and/$or, $eq/$ne/$gt/$gte/$lt/$lte/$in/$nin) as a polars expression."""
+        import polars as pl
+        if "$and" in where or "$or" in where:
+            exprs = [EmbeddedVectorStore.where_expr(c) for c in where.get("$and", where.get("$or"))]
+            combined = exprs[0]
+            for expr in exprs[1:]:
+                combined = (combined & expr) if "$and" in where else (combined | expr)
+            return combined
+        (key, condition), = where.items()
+        column = pl.col(key)
+        if not isinstance(condition, dict):
+            return column == condition
+        (op, value), = condition.items()
+        return {
+            "$eq": lambda: column == value,
+            "$ne": lambda: column != value,
+            "$gt": lambda: column > value,
+            "$gte": lambda: column >= value,
+            "$lt": lambda: column < value,
+            "$lte": lambda: column <= value,
+            "$in": lambda: column.is_in(value),
+            "$nin": lambda: ~column.is_in(value),
+        }[op]()
+    
+    @staticmethod
+    def exact_search(matrix: np.ndarray, embedding: np.ndarray, rows: np.ndarray, n_results: int, block: int = 65536) -> tuple:
+        """Squared L2 (como Chroma) over the given rows, in blocks to bound memory."""
+        distances = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), block):
+            vectors = matrix[rows[start:start + block]]
+            distances[start:start + block] = ((vectors - embedding) ** 2).sum(axis=1)
+        top = np.argsort(distances)[:n_results] if len(rows) <= n_results else np.argpartition(distances, n_results)[:n_results]
+        top = top[np.argsort(distances[top])]
+        return rows[top], distances[top]
+    
+    def index_search(self, index, matrix: np.ndarray, embedding: np.ndarray, total: int, n_results: int, mask: Optional[np.ndarray]) -> tuple:
+        """HNSW (filtrado por la máscara si la hay) + exacto sobre las filas que el índice aún no cubre."""
+        indexed = min(index.get_current_count(), total)
+        allowed = indexed if mask is None else int(mask[:indexed].sum())
+        rows, distances = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if allowed:
+            # El filtro también descarta labels que el manifest todavía no confirma
+            row_filter = (lambda label: label < total) if mask is None else (lambda label: label < total and bool(mask[label]))
+            try:
+                labels, found = index.knn_query(embedding, k=min(n_results, allowed), num_threads=1, filter=row_filter)
+                rows, distances = labels[0].astype(np.int64), found[0]
+            except RuntimeError:
+                # hnswlib no llegó a k resultados con este ef (filtro muy selectivo): exacto sobre lo indexado
+                rows, distances = self.exact_search(matrix, embedding, np.flatnonzero(mask[:indexed]) if mask is not None else np.arange(indexed), n_results)
+        if indexed < total:
+            # Filas confirmadas después del último guardado del índice: búsqueda exacta y merge
+            tail = np.arange(indexed, total)
+            if mask is not None:
+                tail = tail[mask[indexed:]]
+            tail_rows, tail_distances = self.exact_search(matrix, embedding, tail, n_results)
+            rows, distances = np.concatenate([rows, tail_rows]), np.concatenate([distances, tail_distances])
+            order = np.argsort(distances, kind="stable")[:n_results]
+            rows, distances = rows[order], distances[order]
+        return rows, distances
+    
+    def available(self) -> bool:
+        self._refresh()
+        return self.snapshot[1] is not None
+    
+    def query(self, embedding: List[float], n_results: int, where: Optional[dict] = None) -> dict:
+        self._refresh()
+        total, matrix, metadata, index = self.snapshot
+        if not total:
+            return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+        embedding = np.asarray(embedding, dtype=np.float32)
+        # Filtros de metadata como máscara booleana por fila (None = todas)
+        mask = metadata.select(self.where_expr(where)).to_series().to_numpy() if where else None
+        candidates = np.flatnonzero(mask) if mask is not None else np.arange(total)
+        if index is None or (mask is not None and len(candidates) <= max(settings.VECTOR_STORE_EXACT_MAX_ROWS, n_results)):
+            rows, distances = self.exact_search(matrix, embedding, candidates, n_results)
+        else:
+            rows, distances = self.index_search(index, matrix, embedding, total, n_results, mask)
+        
+        hits = metadata[rows.tolist()]
+        return {
+            "ids": [hits["id"].to_list()],
+            "documents": [hits["document"].to_list()],
+            "metadatas": [hits.drop(["row", "id", "document"]).to_dicts()],
+            "distances": [distances.tolist()]
+        }
+    
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "status": "connected" if self.available() else "disconnected",
+            "rows": self.snapshot[0],
+            "hnsw": self.snapshot[3] is not None
+        }
+
+vector_store = EmbeddedVectorStore(settings.VECTOR_STORE_DIR) if settings.VECTOR_STORE == "embedded" else ChromaVectorStore()
 
 # Embedding model (universal para todo el sistema)
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+def load_embedding_model():
+    """Same model as the ETL on the runtime selected by EMBEDDING_BACKEND (torch, onnx, onnx-int8)."""
+    from sentence_transformers import SentenceTransformer
+    backend = settings.EMBEDDING_BACKEND
+    if backend == "torch":
+        if settings.EMBEDDING_THREADS > 0:
+            import torch
+            torch.set_num_threads(settings.EMBEDDING_THREADS)
+        return SentenceTransformer('all-MiniLM-L6-v2')
+    if backend in ("onnx", "onnx-int8"):
+        import onnxruntime as ort
+        session_options = ort.SessionOptions()
+        if settings.EMBEDDING_THREADS > 0:
+            session_options.intra_op_num_threads = settings.EMBEDDING_THREADS
+        model_kwargs = {"provider": "CPUExecutionProvider", "session_options": session_options}
+        if backend == "onnx-int8":
+            model_kwargs["file_name"] = settings.EMBEDDING_ONNX_INT8_FILE
+        return SentenceTransformer('all-MiniLM-L6-v2', backend="onnx", model_kwargs=model_kwargs)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+embedding_model = LazyResource("embedding_model", load_embedding_model)
+
+if settings.PRELOAD_MODELS:
+    # Solo el modelo: clientes HTTP/gRPC no deben cruzar el fork. gc.freeze evita que el
+    # recolector de los workers toque (y copie) las páginas heredadas del master.
+    embedding_model.get()
+    gc.freeze()
 
 # SQLAlchemy Models (sin embeddings, solo datos estructurados)
 class Transaction(Base):
@@ -64,6 +431,16 @@ class Transaction(Base):
     type = Column(String(50), nullable=False)
     category = Column(String(100))
 
+class TransactionRollup(Base):
+    __tablename__ = "transaction_monthly_rollups"
+    month = Column(Date, primary_key=True)
+    type = Column(String(50), primary_key=True)
+    category = Column(String(100), primary_key=True)  # '' cuando la transacción no tiene categoría
+    account_id = Column(String(255), primary_key=True)
+    tx_count = Column(BigInteger, nullable=False)
+    amount_sum = Column(DECIMAL(20,2), nullable=False)
+    abs_amount_sum = Column(DECIMAL(20,2), nullable=False)
+
 class PipelineRun(Base):
     __tablename__ = "pipeline_runs"
     id = Column(Integer, primary_key=True, index=True)
@@ -71,6 +448,14 @@ class PipelineRun(Base):
     status = Column(String(50), nullable=False)
     records_processed = Column(Integer, nullable=False, default=0)
 
+class Insight(Base):
+    __tablename__ = "insights"
+    id = Column(Integer, primary_key=True, index=True)
+    provider = Column(String(50), nullable=False)
+    data_version = Column(Integer, nullable=False)  # id del pipeline_runs exitoso con que se generó
+    insight = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+
 # Pydantic Models
 class TransactionResponse(BaseModel):
     id: int
@@ -103,10 +488,15 @@ class AskRAGResponse(BaseModel):
     answer: str
     provider: str
     sources: List[dict]
+    filters: Optional[dict] = None
+    route: Optional[Literal["vector", "sql"]] = None
 
 class InsightResponse(BaseModel):
     insight: str
     provider: str
+    data_version: Optional[int] = None
+    generated_at: Optional[datetime] = None
+    cached: bool = False
 
 class ModelConfigResponse(BaseModel):
     current_provider: str
@@ -120,117 +510,331 @@ def get_db():
     finally:
         db.close()
 
+# Helper: pool metrics for /health and /metrics/pool
+def get_pool_metrics() -> dict:
+    pool = engine.pool
+    checkouts = pool_stats.checkouts
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "checkouts": checkouts,
+        "timeouts": pool_stats.timeouts,
+        "avg_wait_ms": round(pool_stats.total_wait / checkouts * 1000, 3) if checkouts else 0.0,
+        "max_wait_ms": round(pool_stats.max_wait * 1000, 3)
+    }
+
 # Helper: Generate embeddings
 def generate_embedding(text: str) -> List[float]:
     """Generate embedding using sentence-transformers (consistente en todo el sistema)"""
-    return embedding_model.encode(text).tolist()
+    return embedding_model.get().encode(text).tolist()
 
-# Helper: Generate LLM response based on provider
-def generate_llm_response(prompt: str, provider: Optional[str] = None) -> str:
-    """Generate response using configured LLM provider"""
-    provider = provider or settings.MODEL_PROVIDER
+def encode_texts(texts: List[str]):
+    return embedding_model.get().encode(texts)
+
+class EmbeddingBatcher:
+    """Gathers concurrent encode requests for up to max_wait_ms and runs one batched encode.
+    
+    Un solo worker por proceso consume la cola, así que nunca hay dos forward passes
+    compitiendo por la CPU (ni por el GIL).
+    """
+    
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = 0
+        self.batches = 0
+        self.encode_seconds = 0.0
+        self._queue = None
+        self._worker = None
+    
+    async def encode(self, text: str) -> List[float]:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            start = time.perf_counter()
+            try:
+                vectors = await run_in_threadpool(encode_texts, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.encode_seconds += time.perf_counter() - start
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector.tolist())
+    
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "embeddings_per_second": round(self.requests / self.encode_seconds, 1) if self.encode_seconds else 0.0,
+            "pending": self._queue.qsize() if self._queue else 0
+        }
+
+embedding_batcher = EmbeddingBatcher(settings.EMBEDDING_BATCH_MAX_SIZE, settings.EMBEDDING_BATCH_MAX_WAIT_MS)
+
+# Helper: embedding of a request's text from async endpoints (micro-batched si está habilitado)
+async def embed_text(text: str) -> List[float]:
+    if settings.EMBEDDING_BATCHING_ENABLED:
+        return await embedding_batcher.encode(text)
+    return await run_in_threadpool(generate_embedding, text)
+
+# LLM providers: cada cliente se construye una vez con su pool HTTP keep-alive
+class LLMProvider(ABC):
+    """Shared client for one provider, with a cap on concurrent requests.
+    
+    Cada proveedor implementa _complete (respuesta completa) y _stream (async generator de fragmentos).
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(settings.LLM_MAX_CONCURRENCY)
+    
+    async def complete(self, prompt: str) -> str:
+        async with self.semaphore:
+            return await self._complete(prompt)
+    
+    async def stream(self, prompt: str):
+        """Yield text fragments as the provider emits them (holds a concurrency slot until done)."""
+        async with self.semaphore:
+            async for chunk in self._stream(prompt):
+                if chunk:
+                    yield chunk
+    
+    @abstractmethod
+    async def _complete(self, prompt: str) -> str:
+        ...
+    
+    @abstractmethod
+    def _stream(self, prompt: str):
+        ...
+
+def llm_http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_CONNECTIONS
+    )
+
+class GeminiProvider(LLMProvider):
+    def __init__(self):
+        super().__init__("gemini")
+        import google.generativeai as genai
+        from google.api_core import exceptions as google_exceptions
+        genai.configure(api_key=settings.GOOGLE_API_KEY)
+        # Errores transitorios de la API de Gemini que vale la pena reintentar
+        self.RETRYABLE = (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.InternalServerError,
+        )
+        # genai reutiliza su canal gRPC entre llamadas; el modelo se crea una sola vez
+        self.model = genai.GenerativeModel('gemini-1.5-flash')
+    
+    async def _complete(self, prompt: str) -> str:
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            try:
+                response = await self.model.generate_content_async(
+                    prompt, request_options={"timeout": settings.LLM_TIMEOUT_SECONDS}
+                )
+                return response.text
+            except self.RETRYABLE:
+                if attempt == settings.LLM_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    
+    async def _stream(self, prompt: str):
+        response = await self.model.generate_content_async(
+            prompt, stream=True, request_options={"timeout": settings.LLM_TIMEOUT_SECONDS}
+        )
+        async for chunk in response:
+            yield chunk.text
+
+class OpenAIProvider(LLMProvider):
+    def __init__(self):
+        super().__init__("openai")
+        import openai
+        self.client = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            timeout=settings.LLM_TIMEOUT_SECONDS,
+            max_retries=settings.LLM_MAX_RETRIES,
+            http_client=openai.DefaultAsyncHttpxClient(limits=llm_http_limits())
+        )
+    
+    async def _complete(self, prompt: str) -> str:
+        response = await self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=500
+        )
+        return response.choices[0].message.content
+    
+    async def _stream(self, prompt: str):
+        stream = await self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=500,
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content
+
+class AnthropicProvider(LLMProvider):
+    def __init__(self):
+        super().__init__("anthropic")
+        import anthropic
+        self.client = anthropic.AsyncAnthropic(
+            api_key=settings.ANTHROPIC_API_KEY,
+            timeout=settings.LLM_TIMEOUT_SECONDS,
+            max_retries=settings.LLM_MAX_RETRIES,
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=llm_http_limits())
+        )
     
+    async def _complete(self, prompt: str) -> str:
+        response = await self.client.messages.create(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=500,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response.content[0].text
+    
+    async def _stream(self, prompt: str):
+        async with self.client.messages.stream(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=500,
+            messages=[{"role": "user", "content": prompt}]
+        ) as stream:
+            async for chunk in stream.text_stream:
+                yield chunk
+
+def build_llm_providers() -> dict:
+    """Registry of the providers whose API key is configured (el SDK se importa en el primer uso)."""
+    providers = {}
+    if settings.GOOGLE_API_KEY:
+        providers["gemini"] = LazyResource("gemini", GeminiProvider)
+    if settings.OPENAI_API_KEY:
+        providers["openai"] = LazyResource("openai", OpenAIProvider)
+    if settings.ANTHROPIC_API_KEY:
+        providers["anthropic"] = LazyResource("anthropic", AnthropicProvider)
+    return providers
+
+llm_providers = build_llm_providers()
+
+MISSING_KEY_ERRORS = {
+    "gemini": "Google API key not configured",
+    "openai": "OpenAI API key not configured",
+    "anthropic": "Anthropic API key not configured",
+}
+
+# Helper: provider from the registry, or a 400 explaining why it is unavailable
+def get_llm_provider(provider: Optional[str] = None) -> LLMProvider:
+    provider = provider or settings.MODEL_PROVIDER
+    llm = llm_providers.get(provider)
+    if llm is None:
+        if provider in MISSING_KEY_ERRORS:
+            raise HTTPException(status_code=400, detail=MISSING_KEY_ERRORS[provider])
+        raise HTTPException(status_code=400, detail=f"Unknown provider: {provider}")
+    return llm.get()
+
+# Helper: Generate LLM response based on provider (async: el worker no se bloquea esperando al proveedor)
+async def generate_llm_response(prompt: str, provider: Optional[str] = None) -> str:
+    """Generate response using configured LLM provider"""
     try:
-        if provider == "gemini":
-            if not settings.GOOGLE_API_KEY:
-                raise HTTPException(status_code=400, detail="Google API key not configured")
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(prompt)
-            return response.text
-            
-        elif provider == "openai":
-            if not settings.OPENAI_API_KEY:
-                raise HTTPException(status_code=400, detail="OpenAI API key not configured")
-            openai.api_key = settings.OPENAI_API_KEY
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500
-            )
-            return response.choices[0].message.content
-            
-        elif provider == "anthropic":
-            if not settings.ANTHROPIC_API_KEY:
-                raise HTTPException(status_code=400, detail="Anthropic API key not configured")
-            client = anthropic.Anthropic(api_key=settings.ANTHROPIC_API_KEY)
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=500,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text
-            
-        else:
-            raise HTTPException(status_code=400, detail=f"Unknown provider: {provider}")
+        return await get_llm_provider(provider).complete(prompt)
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM error: {str(e)}")
 
-# Helper: Get KPIs data (mejorado con más métricas)
+# Helper: Get KPIs data
 def get_kpis_data(db: Session):
+    """KPIs from the monthly rollups, falling back to the raw table if they don't exist yet."""
+    if settings.KPI_FROM_ROLLUPS:
+        try:
+            return get_kpis_from_rollups(db)
+        except ProgrammingError as e:
+            db.rollback()
+            print(f"Warning: KPI rollups unavailable, using transactions: {e}")
+    return get_kpis_from_transactions(db)
+
+def get_kpis_from_rollups(db: Session):
+    """Same metrics as get_kpis_from_transactions, read only from transaction_monthly_rollups.
+    
+    El costo depende del número de meses × categorías × cuentas, no del historial de transacciones.
+    """
     current_month = date.today().replace(day=1)
-    last_month = (current_month - timedelta(days=1)).replace(day=1)
+    six_months_ago = (current_month - timedelta(days=180)).replace(day=1)
+    R = TransactionRollup
     
-    # Total moved this month
-    total_moved = db.query(func.sum(func.abs(Transaction.amount))).filter(
-        Transaction.date >= current_month
+    total_moved = db.query(func.sum(R.abs_amount_sum)).filter(
+        R.month >= current_month
     ).scalar() or 0
     
-    # Total outflow this month
-    total_outflow = db.query(func.sum(Transaction.amount)).filter(
-        Transaction.date >= current_month,
-        Transaction.type == "outflow"
+    total_outflow = db.query(func.sum(R.amount_sum)).filter(
+        R.month >= current_month,
+        R.type == "outflow"
     ).scalar() or 0
-
-    # Total savings inflow (all time)
-    savings_inflow = db.query(func.sum(Transaction.amount)).filter(
-        Transaction.type == "inflow",
-        Transaction.category == "savings"
+    
+    savings_inflow = db.query(func.sum(R.amount_sum)).filter(
+        R.type == "inflow",
+        R.category == "savings"
     ).scalar() or 0
-
-    # Category distribution
-    category_dist = db.query(
-        Transaction.category, 
-        func.count(Transaction.id)
-    ).group_by(Transaction.category).all()
-    category_distribution = {cat: count for cat, count in category_dist if cat}
-
-    # Spending by category (only outflows)
-    spending_by_cat = db.query(
-        Transaction.category,
-        func.sum(func.abs(Transaction.amount))
-    ).filter(
-        Transaction.type == "outflow"
-    ).group_by(Transaction.category).all()
+    
+    category_dist = db.query(R.category, func.sum(R.tx_count)).group_by(R.category).all()
+    category_distribution = {cat: int(count) for cat, count in category_dist if cat}
+    
+    spending_by_cat = db.query(R.category, func.sum(R.abs_amount_sum)).filter(
+        R.type == "outflow"
+    ).group_by(R.category).all()
     spending_by_category = {cat: float(amount) for cat, amount in spending_by_cat if cat}
-
-    # Top inflow accounts
-    top_accounts = db.query(
-        Transaction.account_id, 
-        func.sum(Transaction.amount)
-    ).filter(
-        Transaction.type == "inflow"
-    ).group_by(Transaction.account_id).order_by(
-        desc(func.sum(Transaction.amount))
-    ).limit(5).all()
+    
+    top_accounts = db.query(R.account_id, func.sum(R.amount_sum)).filter(
+        R.type == "inflow"
+    ).group_by(R.account_id).order_by(desc(func.sum(R.amount_sum))).limit(5).all()
     top_inflow_accounts = [{"account_id": acc[:12] + "...", "total": float(total)} for acc, total in top_accounts]
-
-    # Monthly trend (last 6 months)
-    six_months_ago = (current_month - timedelta(days=180)).replace(day=1)
+    
     monthly_data = db.query(
-        func.date_trunc('month', Transaction.date).label('month'),
-        func.sum(Transaction.amount).filter(Transaction.type == "inflow").label('inflow'),
-        func.sum(func.abs(Transaction.amount)).filter(Transaction.type == "outflow").label('outflow')
+        R.month,
+        func.sum(R.amount_sum).filter(R.type == "inflow").label('inflow'),
+        func.sum(R.abs_amount_sum).filter(R.type == "outflow").label('outflow')
     ).filter(
-        Transaction.date >= six_months_ago
-    ).group_by('month').order_by('month').all()
+        R.month >= six_months_ago
+    ).group_by(R.month).order_by(R.month).all()
     
     monthly_trend = [{
-        "month": str(row.month.date()) if row.month else "",
+        "month": str(row.month),
         "inflow": float(row.inflow or 0),
         "outflow": float(row.outflow or 0)
     } for row in monthly_data]
-
+    
     return {
         "total_moved_month": float(total_moved),
         "total_savings_inflow": float(savings_inflow),
@@ -241,6 +845,615 @@ def get_kpis_data(db: Session):
         "spending_by_category": spending_by_category
     }
 
+# Una sola pasada sobre transactions: GROUPING SETS para totales, categorías, cuentas y meses,
+# con agregados condicionales (FILTER) en lugar de una consulta por métrica
+KPI_SINGLE_PASS_SQL = text("""
+WITH grouped AS (
+    SELECT
+        GROUPING(category) AS by_category,
+        GROUPING(account_id) AS by_account,
+        GROUPING(month) AS by_month,
+        category, account_id, month,
+        count(*) AS tx_count,
+        sum(abs(amount)) FILTER (WHERE date >= :current_month) AS moved_month,
+        sum(amount) FILTER (WHERE date >= :current_month AND type = 'outflow') AS outflow_month,
+        sum(amount) FILTER (WHERE type = 'inflow' AND category = 'savings') AS savings_inflow,
+        sum(amount) FILTER (WHERE type = 'inflow') AS inflow,
+        sum(abs(amount)) FILTER (WHERE type = 'outflow') AS outflow
+    FROM (SELECT *, date_trunc('month', date) AS month FROM transactions) t
+    GROUP BY GROUPING SETS ((), (category), (account_id), (month))
+)
+SELECT * FROM grouped
+WHERE by_account = 1
+   OR account_id IN (
+       SELECT account_id FROM grouped
+       WHERE by_account = 0 AND inflow IS NOT NULL
+       ORDER BY inflow DESC
+       LIMIT 5
+   )
+""")
+
+def get_kpis_from_transactions(db: Session):
+    """All KPIs from a single scan of transactions (fallback when rollups are not available)."""
+    current_month = date.today().replace(day=1)
+    six_months_ago = (current_month - timedelta(days=180)).replace(day=1)
+    
+    rows = db.execute(KPI_SINGLE_PASS_SQL, {"current_month": current_month}).all()
+    
+    totals = None
+    category_distribution = {}
+    spending_by_category = {}
+    top_accounts = []
+    monthly_trend = []
+    for row in rows:
+        if row.by_category == 0:
+            if row.category:
+                category_distribution[row.category] = row.tx_count
+                if row.outflow is not None:
+                    spending_by_category[row.category] = float(row.outflow)
+        elif row.by_account == 0:
+            top_accounts.append((row.account_id, row.inflow))
+        elif row.by_month == 0:
+            # Últimos 6 meses (los meses empiezan el día 1, igual que six_months_ago)
+            if row.month and row.month.date() >= six_months_ago:
+                monthly_trend.append({
+                    "month": str(row.month.date()),
+                    "inflow": float(row.inflow or 0),
+                    "outflow": float(row.outflow or 0)
+                })
+        else:
+            totals = row
+    
+    top_accounts.sort(key=lambda acc: acc[1], reverse=True)
+    top_inflow_accounts = [{"account_id": acc[:12] + "...", "total": float(total)} for acc, total in top_accounts]
+    monthly_trend.sort(key=lambda m: m["month"])
+    
+    return {
+        "total_moved_month": float(totals.moved_month or 0) if totals else 0.0,
+        "total_savings_inflow": float(totals.savings_inflow or 0) if totals else 0.0,
+        "total_outflow_month": float(abs(totals.outflow_month or 0)) if totals else 0.0,
+        "category_distribution": category_distribution,
+        "top_inflow_accounts": top_inflow_accounts,
+        "monthly_trend": monthly_trend,
+        "spending_by_category": spending_by_category
+    }
+
+# Result cache (invalidado por versión de datos = último pipeline_runs exitoso)
+class ResultCache:
+    """Cache of serialized endpoint results keyed by endpoint + params and data version.
+    
+    In-process by default; with REDIS_URL the entries are shared by every worker. Si Redis
+    falla, get cuenta un miss y set no guarda nada: el endpoint calcula el resultado igual.
+    """
+    
+    def __init__(self, ttl_seconds: int, redis_url: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        self._redis_failing = False
+        if redis_url:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(redis_url)
+                self._redis_error = redis.RedisError
+            except ImportError:
+                print("Warning: REDIS_URL set but redis package not installed, using in-process cache")
+    
+    def _redis_call(self, method: str, *args):
+        """Run a Redis command; on error log once per outage and return None."""
+        try:
+            result = getattr(self._redis, method)(*args)
+        except self._redis_error as e:
+            self.errors += 1
+            if not self._redis_failing:
+                print(f"Warning: result cache Redis unavailable ({e}), computing results directly")
+            self._redis_failing = True
+            return None
+        self._redis_failing = False
+        return result
+    
+    def get(self, key: str, version: int) -> Optional[bytes]:
+        if self._redis is not None:
+            body = self._redis_call("get", f"manbank:result:{key}:{version}")
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+            body = entry[2] if entry and entry[0] == version and entry[1] > time.monotonic() else None
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+    
+    def set(self, key: str, version: int, body: bytes):
+        if self._redis is not None:
+            self._redis_call("setex", f"manbank:result:{key}:{version}", self.ttl_seconds, body)
+        else:
+            with self._lock:
+                self._entries[key] = (version, time.monotonic() + self.ttl_seconds, body)
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": "redis" if self._redis is not None else "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+result_cache = ResultCache(settings.RESULT_CACHE_TTL_SECONDS, settings.REDIS_URL)
+_data_version = {"value": 0, "checked_at": float("-inf")}
+
+# Helper: data version (id del último pipeline_runs exitoso), consultada como mucho cada N segundos
+def get_data_version(db: Optional[Session] = None, fresh: bool = False) -> int:
+    now = time.monotonic()
+    if fresh or now - _data_version["checked_at"] >= settings.DATA_VERSION_CHECK_SECONDS:
+        own_session = db is None
+        db = SessionLocal() if own_session else db
+        try:
+            _data_version["value"] = db.query(func.max(PipelineRun.id)).filter(
+                PipelineRun.status == "success"
+            ).scalar() or 0
+        finally:
+            if own_session:
+                db.close()
+        _data_version["checked_at"] = now
+    return _data_version["value"]
+
+# Semantic answer cache para /llm/ask_rag
+class SemanticAnswerCache:
+    """Answers keyed by question embedding: a new question reuses a stored answer when it is
+    within the cosine-similarity threshold, for the same scope (provider + query filters)
+    and data version.
+    
+    LRU con TTL; el tamaño está acotado, así que la búsqueda lineal sobre la matriz es barata.
+    """
+    
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # id -> (vector, scope, version, expires_at, response)
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def get(self, embedding, scope: str, version: int):
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            for entry_id in [k for k, e in self._entries.items() if e[3] <= now or e[2] != version]:
+                del self._entries[entry_id]
+            candidates = [(k, e) for k, e in self._entries.items() if e[1] == scope]
+            if candidates:
+                similarities = np.stack([e[0] for _, e in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry[4]
+            self.misses += 1
+            return None
+    
+    def put(self, embedding, scope: str, version: int, response):
+        with self._lock:
+            self._entries[self._next_id] = (
+                self._normalize(embedding), scope, version, time.monotonic() + self.ttl_seconds, response
+            )
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+def rag_cache_scope(provider: str, filters: dict) -> str:
+    # "gastos de marzo" y "gastos de abril" son casi idénticas como embedding: los filtros separan
+    return f"{provider}|{json.dumps(filters, default=str, sort_keys=True)}"
+
+semantic_cache = SemanticAnswerCache(
+    settings.SEMANTIC_CACHE_THRESHOLD, settings.SEMANTIC_CACHE_MAX_ENTRIES, settings.SEMANTIC_CACHE_TTL_SECONDS
+)
+
+# Helper: serve a cached JSON result with ETag / If-None-Match
+def cached_json_response(request: Request, key: str, db: Session, compute: Callable[[], object]) -> Response:
+    version = get_data_version(db)
+    body = result_cache.get(key, version)
+    if body is None:
+        body = json.dumps(jsonable_encoder(compute())).encode()
+        result_cache.set(key, version, body)
+    
+    etag = f'"{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# RAG query planner: fechas, categoría y tipo extraídos de la pregunta → filtros `where` de Chroma
+MONTHS = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6, "july": 7,
+    "august": 8, "september": 9, "october": 10, "november": 11, "december": 12,
+}
+# Mismas categorías que asigna el ETL (classify_descriptions)
+CATEGORY_TERMS = {
+    "Nómina": ["nomina", "salario", "sueldo", "salary"],
+    "Transferencia": ["transferencia", "transferencias", "transfer"],
+    "Supermercado": ["supermercado", "supermercados", "mercado", "grocery"],
+    "Restaurantes": ["restaurante", "restaurantes", "comida", "food"],
+    "Transporte": ["transporte", "uber", "taxi", "gasolina"],
+    "savings": ["ahorro", "ahorros", "savings"],
+    "Servicios": ["servicios", "servicio", "utility", "utilities"],
+}
+TYPE_TERMS = {
+    "outflow": ["gasto", "gastos", "gaste", "egreso", "egresos", "pague", "pagos", "compras", "spent", "spending"],
+    "inflow": ["ingreso", "ingresos", "recibi", "deposito", "depositos", "income"],
+}
+STOPWORDS = {
+    "de", "la", "el", "en", "y", "a", "los", "las", "del", "por", "con", "para", "que", "mi", "mis",
+    "un", "una", "cuanto", "cual", "cuales", "como", "se", "al", "lo", "es", "fue", "the", "of", "in",
+}
+
+# Palabras de la pregunta que no describen transacciones (tiempo, agregación, genéricas): lo que
+# queda después de quitarlas y de los términos del planner se filtra por descripción (p. ej. "starbucks")
+NON_KEYWORD_TERMS = {
+    "cuanto", "cuanta", "cuantos", "cuantas", "total", "totales", "suma", "sumar", "promedio",
+    "how", "much", "many", "average", "sum", "este", "esta", "estos", "mes", "meses", "pasado", "ultimo",
+    "ultimos", "ano", "anos", "semana", "hoy", "ayer", "year", "month", "last", "this", "dinero", "plata",
+    "tengo", "tuve", "gastado", "pagado", "hice", "hay", "han", "mas", "menos", "todo", "todos", "todas",
+    "cada", "compra", "pago", "transaccion", "transacciones", "movimiento", "movimientos", "cuenta",
+    "cuentas", "money", "did", "spend", "what", "was", "were", "my", "on", "at", "for", "to", "is", "are",
+    "have", "durante", "desde", "hasta", "entre", "sobre",
+}
+
+# Un año solo cuenta junto a un mes o tras "año"/"en"/"durante": "compras de más de 2000" es un monto
+YEAR_PATTERN = re.compile(
+    r"\b(?:(?:" + "|".join(MONTHS) + r")(?:\s+(?:de|del|of))?,?|ano|en|in|year|durante|desde)\s+(20\d{2})\b"
+)
+# "may" en inglés es también el verbo ("how much may I spend"): solo es mes tras "in" o antes de un año
+MAY_MONTH_PATTERN = re.compile(r"\b(?:in\s+may|may(?:\s+of)?,?\s+20\d{2})\b")
+
+def normalize_text(text_value: str) -> str:
+    """Lowercase without accents (las preguntas llegan con y sin tildes)."""
+    decomposed = unicodedata.normalize("NFKD", text_value.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(text_value: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", normalize_text(text_value)) if t not in STOPWORDS]
+
+def month_range(year: int, month: int) -> tuple:
+    start = date(year, month, 1)
+    end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return start, end
+
+def plan_rag_query(question: str, today: Optional[date] = None) -> dict:
+    """Extract start_date/end_date, category and type filters from a question."""
+    today = today or date.today()
+    normalized = normalize_text(question)
+    tokens = set(re.findall(r"\w+", normalized))
+    filters = {}
+    
+    # Fechas: "este mes", "mes pasado", "este año", "<mes> [de] [año]", "<año>"
+    year_match = YEAR_PATTERN.search(normalized)
+    month = next(
+        (MONTHS[t] for t in re.findall(r"\w+", normalized) if t in MONTHS and (t != "may" or MAY_MONTH_PATTERN.search(normalized))),
+        None
+    )
+    if "este mes" in normalized:
+        filters["start_date"], filters["end_date"] = month_range(today.year, today.month)
+    elif "mes pasado" in normalized or "ultimo mes" in normalized:
+        previous = today.replace(day=1) - timedelta(days=1)
+        filters["start_date"], filters["end_date"] = month_range(previous.year, previous.month)
+    elif month:
+        # Sin año explícito: la ocurrencia más reciente de ese mes
+        year = int(year_match.group(1)) if year_match else (today.year if month <= today.month else today.year - 1)
+        filters["start_date"], filters["end_date"] = month_range(year, month)
+    elif year_match:
+        year = int(year_match.group(1))
+        filters["start_date"], filters["end_date"] = date(year, 1, 1), date(year, 12, 31)
+    elif "este ano" in normalized:
+        filters["start_date"], filters["end_date"] = date(today.year, 1, 1), today
+    
+    for category, terms in CATEGORY_TERMS.items():
+        if tokens.intersection(terms):
+            filters["category"] = category
+            break
+    for tx_type, terms in TYPE_TERMS.items():
+        if tokens.intersection(terms):
+            filters["type"] = tx_type
+            break
+    
+    # Comercios o conceptos que el planner no mapea: filtro por descripción (ruta SQL) y scope de cache
+    planner_terms = set(MONTHS).union(*CATEGORY_TERMS.values(), *TYPE_TERMS.values())
+    keywords = [
+        t for t in dict.fromkeys(re.findall(r"\w+", normalized))
+        if len(t) >= 3 and not t.isdigit() and t not in STOPWORDS and t not in NON_KEYWORD_TERMS and t not in planner_terms
+    ]
+    if keywords:
+        filters["keywords"] = keywords
+    return filters
+
+def build_chroma_where(filters: dict) -> Optional[dict]:
+    """Translate planner filters to a Chroma `where` clause (date_num = YYYYMMDD, lo escribe el ETL)."""
+    clauses = []
+    if "start_date" in filters:
+        clauses.append({"date_num": {"$gte": int(filters["start_date"].strftime("%Y%m%d"))}})
+        clauses.append({"date_num": {"$lte": int(filters["end_date"].strftime("%Y%m%d"))}})
+    if "category" in filters:
+        clauses.append({"category": filters["category"]})
+    if "type" in filters:
+        clauses.append({"type": filters["type"]})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def bm25_scores(query_tokens: List[str], documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """BM25 of the query over the candidate documents (estadísticas del propio conjunto de candidatos)."""
+    docs_tokens = [tokenize(doc) for doc in documents]
+    if not docs_tokens:
+        return []
+    avg_len = sum(len(d) for d in docs_tokens) / len(docs_tokens) or 1.0
+    n_docs = len(docs_tokens)
+    scores = []
+    for doc_tokens in docs_tokens:
+        score = 0.0
+        for term in set(query_tokens):
+            tf = doc_tokens.count(term)
+            if not tf:
+                continue
+            df = sum(1 for d in docs_tokens if term in d)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc_tokens) / avg_len))
+        scores.append(score)
+    return scores
+
+def min_max(values: List[float]) -> List[float]:
+    low, high = min(values), max(values)
+    return [(v - low) / (high - low) if high > low else 0.0 for v in values]
+
+def hybrid_rank(question: str, documents: List[str], distances: List[float], top_k: int) -> List[int]:
+    """Indices of the top_k candidates by alpha * vector similarity + (1 - alpha) * BM25."""
+    vector_scores = min_max([-d for d in distances])
+    keyword_scores = min_max(bm25_scores(tokenize(question), documents))
+    alpha = settings.RAG_HYBRID_ALPHA
+    combined = [alpha * v + (1 - alpha) * k for v, k in zip(vector_scores, keyword_scores)]
+    return sorted(range(len(documents)), key=lambda i: combined[i], reverse=True)[:top_k]
+
+# Helper: retrieve the top transactions for a question and build the RAG prompt
+async def retrieve_rag_context(question: str, question_embedding: List[float], filters: Optional[dict] = None) -> tuple:
+    where = build_chroma_where(filters or {})
+    results = await run_in_threadpool(
+        vector_store.query, question_embedding, settings.RAG_CANDIDATES, where
+    )
+    if where and not (results['documents'] and results['documents'][0]):
+        # Sin coincidencias con filtros (p. ej. documentos cargados antes de date_num): búsqueda abierta
+        results = await run_in_threadpool(vector_store.query, question_embedding, settings.RAG_CANDIDATES)
+    
+    # Build context from results (re-ranking híbrido vector + BM25 sobre los candidatos)
+    sources = []
+    context_parts = []
+    
+    if results['documents'] and results['documents'][0]:
+        documents = results['documents'][0]
+        distances = results['distances'][0] if results.get('distances') else [0.0] * len(documents)
+        for i in hybrid_rank(question, documents, distances, settings.RAG_TOP_K):
+            doc = documents[i]
+            metadata = results['metadatas'][0][i] if results['metadatas'] else {}
+            context_parts.append(doc)
+            sources.append({
+                "text": doc[:100] + "...",
+                "metadata": metadata
+            })
+    
+    context = "\n".join(context_parts) if context_parts else "No hay transacciones relevantes."
+    
+    prompt = f"""Eres un asistente financiero experto. Basándote en el siguiente contexto de transacciones bancarias, responde la pregunta del usuario de manera clara y concisa.
+
+Contexto de transacciones:
+{context}
+
+Pregunta del usuario: {question}
+
+Responde en español, siendo preciso y profesional. Si el contexto no tiene suficiente información, indícalo."""
+    return sources, prompt
+
+# Aggregate routing: preguntas de totales/conteos/promedios se responden con SQL, no con top-k documentos
+AGGREGATE_QUESTION = re.compile(
+    r"\b(cuanto|cuanta|cuantos|cuantas|total|totales|suma|sumar|promedio|how much|how many|average|sum)\b"
+)
+
+def is_aggregate_question(question: str) -> bool:
+    return bool(AGGREGATE_QUESTION.search(normalize_text(question)))
+
+def aggregate_rag_context(question: str, filters: dict) -> Optional[tuple]:
+    """Run the parameterized aggregate for the planner filters and build a compact prompt.
+    
+    Todo se agrupa por type: sumar ingresos y egresos en un solo total no significa nada.
+    Las keywords filtran la descripción; si con ellas no hay filas devuelve None y la
+    pregunta va por la ruta vectorial (la keyword puede no ser un comercio).
+    """
+    start_date, end_date = filters.get("start_date"), filters.get("end_date")
+    category, tx_type = filters.get("category"), filters.get("type")
+    keywords = filters.get("keywords")
+    db = SessionLocal()
+    try:
+        summary = filter_transactions(db.query(
+            Transaction.type,
+            func.count(Transaction.id),
+            func.sum(func.abs(Transaction.amount)),
+            func.avg(func.abs(Transaction.amount)),
+            func.min(Transaction.date),
+            func.max(Transaction.date)
+        ), start_date, end_date, category, tx_type, keywords).group_by(Transaction.type).order_by(Transaction.type).all()
+        if keywords and not summary:
+            return None
+        
+        breakdown = []
+        if not category:
+            breakdown = filter_transactions(db.query(
+                Transaction.type,
+                Transaction.category,
+                func.count(Transaction.id),
+                func.sum(func.abs(Transaction.amount))
+            ), start_date, end_date, category, tx_type, keywords).group_by(Transaction.type, Transaction.category).order_by(
+                Transaction.type, desc(func.sum(func.abs(Transaction.amount)))
+            ).all()
+    finally:
+        db.close()
+    
+    by_type = {}
+    for flow_type, count, total, average, first_date, last_date in summary:
+        by_type[flow_type] = {
+            "transactions": int(count),
+            "total_amount": float(total or 0),
+            "average_amount": float(average or 0),
+            "first_date": first_date,
+            "last_date": last_date,
+            "by_category": {}
+        }
+    for flow_type, cat, n, t in breakdown:
+        categories = by_type[flow_type]["by_category"]
+        if len(categories) < 10:
+            categories[cat or "Sin categoría"] = {"transactions": int(n), "total": float(t or 0)}
+    result = {"transactions": sum(v["transactions"] for v in by_type.values()), "by_type": by_type}
+    
+    applied = {k: str(v) for k, v in filters.items()} or "ninguno (todas las transacciones)"
+    sections = []
+    for flow_type, v in by_type.items():
+        lines = [
+            f"Tipo {flow_type}:",
+            f"- Número de transacciones: {v['transactions']}",
+            f"- Monto total (valor absoluto): ${v['total_amount']:,.2f}",
+            f"- Monto promedio: ${v['average_amount']:,.2f}",
+            f"- Periodo con datos: {v['first_date'] or '-'} a {v['last_date'] or '-'}",
+        ]
+        if v["by_category"]:
+            lines.append("- Desglose por categoría:")
+            lines.extend(
+                f"  - {cat}: {c['transactions']} transacciones, ${c['total']:,.2f}" for cat, c in v["by_category"].items()
+            )
+        sections.append("\n".join(lines))
+    results_text = "\n\n".join(sections) or "Sin transacciones para estos filtros."
+    
+    prompt = f"""Eres un asistente financiero experto. Responde la pregunta del usuario usando únicamente el siguiente resultado, calculado con SQL sobre todas sus transacciones y separado por tipo de flujo (inflow = ingresos, outflow = egresos).
+
+Filtros aplicados: {applied}
+
+{results_text}
+
+Pregunta del usuario: {question}
+
+Responde en español, siendo preciso y profesional. Reporta cada tipo de flujo por separado y nunca sumes ingresos con egresos; si hace falta un neto, calcúlalo como ingresos menos egresos. Si no hay transacciones para esos filtros, indícalo."""
+    sources = [{"text": "Consulta agregada sobre transactions", "metadata": jsonable_encoder(result)}]
+    return sources, prompt
+
+# Helper: route the question (SQL aggregate or vector retrieval) and build its prompt
+async def build_rag_context(question: str, question_embedding: List[float], filters: dict) -> tuple:
+    if is_aggregate_question(question):
+        context = await run_in_threadpool(aggregate_rag_context, question, filters)
+        if context is not None:
+            sources, prompt = context
+            return sources, prompt, "sql"
+    # Solo la ruta vectorial necesita el vector store
+    if not await run_in_threadpool(vector_store.available):
+        raise HTTPException(status_code=503, detail="Vector store not available")
+    sources, prompt = await retrieve_rag_context(question, question_embedding, filters)
+    return sources, prompt, "vector"
+
+# Helper: executive insight prompt from the KPIs
+def build_insight_prompt(kpis: dict) -> str:
+    return f"""Eres un analista financiero senior. Genera un insight ejecutivo (máximo 4 líneas) basado en los siguientes KPIs:
+
+- Total movido este mes: ${kpis['total_moved_month']:,.2f}
+- Egresos este mes: ${kpis['total_outflow_month']:,.2f}
+- Ahorros acumulados: ${kpis['total_savings_inflow']:,.2f}
+- Distribución por categoría: {kpis['category_distribution']}
+- Top cuentas de ingreso: {kpis['top_inflow_accounts']}
+
+Genera un resumen ejecutivo profesional en español, destacando lo más relevante."""
+
+# Helper: insights persistidos por (proveedor, versión de datos)
+def load_insight(db: Session, provider: str, data_version: int) -> Optional[Insight]:
+    try:
+        return db.query(Insight).filter(
+            Insight.provider == provider,
+            Insight.data_version == data_version
+        ).first()
+    except ProgrammingError:
+        # Tabla aún no creada (la crea el ETL): se genera sin cache
+        db.rollback()
+        return None
+
+def save_insight(provider: str, data_version: int, insight: str) -> datetime:
+    generated_at = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        stmt = pg_insert(Insight).values(
+            provider=provider, data_version=data_version, insight=insight, created_at=generated_at
+        )
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[Insight.provider, Insight.data_version],
+            set_={"insight": stmt.excluded.insight, "created_at": stmt.excluded.created_at}
+        ))
+        db.commit()
+    except ProgrammingError as e:
+        db.rollback()
+        print(f"Warning: could not store insight: {e}")
+    finally:
+        db.close()
+    return generated_at
+
+# Helper: Server-Sent Events
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+def sse_response(events) -> StreamingResponse:
+    # X-Accel-Buffering evita que un proxy nginx acumule los tokens
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def stream_llm_events(llm: LLMProvider, prompt: str, on_complete: Optional[Callable[[str], object]] = None):
+    """`token` events as the provider emits text, then `done` with the full text (or `error`).
+    
+    on_complete runs in the threadpool with the full text, so it may write to the database.
+    """
+    parts = []
+    try:
+        async for chunk in llm.stream(prompt):
+            parts.append(chunk)
+            yield sse_event("token", {"text": chunk})
+    except Exception as e:
+        yield sse_event("error", {"detail": f"LLM error: {str(e)}"})
+        return
+    full_text = "".join(parts)
+    if on_complete:
+        await run_in_threadpool(on_complete, full_text)
+    yield sse_event("done", {"text": full_text})
+
 # FastAPI App
 app = FastAPI(
     title="ManBank API",
@@ -255,6 +1468,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # Endpoints
@@ -269,24 +1483,32 @@ def read_root():
 def health_check():
     return {
         "status": "healthy",
-        "chromadb": "connected" if collection else "disconnected",
-        "provider": settings.MODEL_PROVIDER
+        # Clave histórica: estado de la conexión lazy a Chroma (disconnected hasta la primera consulta)
+        "chromadb": "connected" if chroma_collection.loaded else "disconnected",
+        "vector_store": vector_store.stats(),
+        "provider": settings.MODEL_PROVIDER,
+        "embedding_backend": settings.EMBEDDING_BACKEND,
+        "result_cache": result_cache.stats(),
+        "db_pool": get_pool_metrics(),
+        "semantic_cache": semantic_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "lazy_resources": {
+            resource.name: {"loaded": resource.loaded, "load_seconds": resource.load_seconds}
+            for resource in [embedding_model, chroma_collection, *llm_providers.values()]
+        }
     }
 
+@app.get("/metrics/pool")
+def pool_metrics():
+    """Connection pool saturation (checked out, overflow, wait time)"""
+    return get_pool_metrics()
+
 @app.get("/config/model", response_model=ModelConfigResponse)
 def get_model_config():
     """Get current model configuration"""
-    available = []
-    if settings.GOOGLE_API_KEY:
-        available.append("gemini")
-    if settings.OPENAI_API_KEY:
-        available.append("openai")
-    if settings.ANTHROPIC_API_KEY:
-        available.append("anthropic")
-    
     return ModelConfigResponse(
         current_provider=settings.MODEL_PROVIDER,
-        available_providers=available
+        available_providers=list(llm_providers)
     )
 
 @app.get("/status/pipeline", response_model=PipelineStatus)
@@ -304,131 +1526,314 @@ def get_pipeline_status(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/analytics/kpis", response_model=KPIMetrics)
-def get_kpis(db: Session = Depends(get_db)):
+def get_kpis(request: Request, db: Session = Depends(get_db)):
     try:
-        data = get_kpis_data(db)
-        return KPIMetrics(**data)
+        return cached_json_response(request, "kpis", db, lambda: KPIMetrics(**get_kpis_data(db)))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/llm/ask_rag", response_model=AskRAGResponse)
-def ask_rag(request: AskRAGRequest, db: Session = Depends(get_db)):
+async def ask_rag(request: AskRAGRequest):
     try:
-        if not collection:
-            raise HTTPException(status_code=503, detail="ChromaDB not available")
-        
-        # Generate embedding for the question using all-MiniLM-L6-v2
-        question_embedding = generate_embedding(request.question)
-        
-        # Search in ChromaDB
-        results = collection.query(
-            query_embeddings=[question_embedding],
-            n_results=5
-        )
-        
-        # Build context from results
-        sources = []
-        context_parts = []
+        # Generate embedding for the question using all-MiniLM-L6-v2 (micro-batch, fuera del event loop)
+        question_embedding = await embed_text(request.question)
+        provider_used = request.provider or settings.MODEL_PROVIDER
+        filters = plan_rag_query(request.question)
+        cache_scope = rag_cache_scope(provider_used, filters)
         
-        if results['documents'] and results['documents'][0]:
-            for i, doc in enumerate(results['documents'][0]):
-                metadata = results['metadatas'][0][i] if results['metadatas'] else {}
-                context_parts.append(doc)
-                sources.append({
-                    "text": doc[:100] + "...",
-                    "metadata": metadata
-                })
+        # Pregunta casi idéntica ya respondida con los mismos datos: sin Chroma ni LLM
+        if settings.SEMANTIC_CACHE_ENABLED:
+            data_version = await run_in_threadpool(get_data_version)
+            cached = semantic_cache.get(question_embedding, cache_scope, data_version)
+            if cached is not None:
+                return cached
         
-        context = "\n".join(context_parts) if context_parts else "No hay transacciones relevantes."
+        # Agregados vía SQL, o búsqueda en ChromaDB (filtros de metadata + ranking híbrido)
+        sources, prompt, route = await build_rag_context(request.question, question_embedding, filters)
         
         # Generate answer using selected provider
-        prompt = f"""Eres un asistente financiero experto. Basándote en el siguiente contexto de transacciones bancarias, responde la pregunta del usuario de manera clara y concisa.
-
-Contexto de transacciones:
-{context}
-
-Pregunta del usuario: {request.question}
-
-Responde en español, siendo preciso y profesional. Si el contexto no tiene suficiente información, indícalo."""
-
-        answer = generate_llm_response(prompt, request.provider)
-        provider_used = request.provider or settings.MODEL_PROVIDER
+        answer = await generate_llm_response(prompt, request.provider)
         
-        return AskRAGResponse(
+        response = AskRAGResponse(
             answer=answer,
             provider=provider_used,
-            sources=sources
+            sources=sources,
+            filters=filters,
+            route=route
         )
+        if settings.SEMANTIC_CACHE_ENABLED:
+            semantic_cache.put(question_embedding, cache_scope, data_version, response)
+        return response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/llm/ask_rag/stream")
+async def ask_rag_stream(request: AskRAGRequest):
+    """Streaming /llm/ask_rag (SSE): `sources` first, then `token` events, then `done`."""
+    llm = get_llm_provider(request.provider)
+    provider_used = llm.name
+    
+    try:
+        question_embedding = await embed_text(request.question)
+        filters = plan_rag_query(request.question)
+        cache_scope = rag_cache_scope(provider_used, filters)
+        data_version = None
+        if settings.SEMANTIC_CACHE_ENABLED:
+            data_version = await run_in_threadpool(get_data_version)
+            cached = semantic_cache.get(question_embedding, cache_scope, data_version)
+            if cached is not None:
+                async def cached_events():
+                    yield sse_event("sources", {
+                        "sources": cached.sources, "provider": provider_used, "filters": filters, "route": cached.route
+                    })
+                    yield sse_event("token", {"text": cached.answer})
+                    yield sse_event("done", {"text": cached.answer})
+                return sse_response(cached_events())
         
+        sources, prompt, route = await build_rag_context(request.question, question_embedding, filters)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    def cache_answer(answer: str):
+        if settings.SEMANTIC_CACHE_ENABLED:
+            semantic_cache.put(
+                question_embedding, cache_scope, data_version,
+                AskRAGResponse(answer=answer, provider=provider_used, sources=sources, filters=filters, route=route)
+            )
+    
+    async def events():
+        yield sse_event("sources", {"sources": sources, "provider": provider_used, "filters": filters, "route": route})
+        async for event in stream_llm_events(llm, prompt, cache_answer):
+            yield event
+    
+    return sse_response(events())
 
 @app.get("/llm/generate_insight", response_model=InsightResponse)
-def generate_insight(
+async def generate_insight(
     db: Session = Depends(get_db),
-    provider: Optional[Literal["gemini", "openai", "anthropic"]] = None
+    provider: Optional[Literal["gemini", "openai", "anthropic"]] = None,
+    refresh: bool = False
 ):
+    """Executive insight for the current data version.
+    
+    Se genera una vez por (proveedor, versión de datos) y se guarda en PostgreSQL; el ETL
+    lo pre-calcula al terminar cada carga. `refresh=true` fuerza regenerarlo.
+    """
     try:
-        # Get KPIs
-        kpis = get_kpis_data(db)
+        provider_used = provider or settings.MODEL_PROVIDER
+        data_version = await run_in_threadpool(get_data_version, db, refresh)
+        if not refresh:
+            stored = await run_in_threadpool(load_insight, db, provider_used, data_version)
+            if stored:
+                return InsightResponse(
+                    insight=stored.insight, provider=provider_used, data_version=data_version,
+                    generated_at=stored.created_at, cached=True
+                )
         
-        prompt = f"""Eres un analista financiero senior. Genera un insight ejecutivo (máximo 4 líneas) basado en los siguientes KPIs:
-
-- Total movido este mes: ${kpis['total_moved_month']:,.2f}
-- Egresos este mes: ${kpis['total_outflow_month']:,.2f}
-- Ahorros acumulados: ${kpis['total_savings_inflow']:,.2f}
-- Distribución por categoría: {kpis['category_distribution']}
-- Top cuentas de ingreso: {kpis['top_inflow_accounts']}
-
-Genera un resumen ejecutivo profesional en español, destacando lo más relevante."""
+        # Get KPIs (consulta síncrona, en el threadpool)
+        kpis = await run_in_threadpool(get_kpis_data, db)
+        
+        prompt = build_insight_prompt(kpis)
 
-        insight = generate_llm_response(prompt, provider)
-        provider_used = provider or settings.MODEL_PROVIDER
+        insight = await generate_llm_response(prompt, provider)
+        generated_at = await run_in_threadpool(save_insight, provider_used, data_version, insight)
         
-        return InsightResponse(insight=insight, provider=provider_used)
+        return InsightResponse(
+            insight=insight, provider=provider_used, data_version=data_version, generated_at=generated_at
+        )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/llm/generate_insight/stream")
+async def generate_insight_stream(
+    db: Session = Depends(get_db),
+    provider: Optional[Literal["gemini", "openai", "anthropic"]] = None,
+    refresh: bool = False
+):
+    """Streaming /llm/generate_insight (SSE): `token` events, then `done`."""
+    llm = get_llm_provider(provider)
+    try:
+        data_version = await run_in_threadpool(get_data_version, db, refresh)
+        stored = None if refresh else await run_in_threadpool(load_insight, db, llm.name, data_version)
+        kpis = None if stored else await run_in_threadpool(get_kpis_data, db)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def events():
+        yield sse_event("meta", {"provider": llm.name, "data_version": data_version, "cached": stored is not None})
+        if stored:
+            yield sse_event("token", {"text": stored.insight})
+            yield sse_event("done", {"text": stored.insight})
+            return
+        async for event in stream_llm_events(
+            llm, build_insight_prompt(kpis), lambda insight: save_insight(llm.name, data_version, insight)
+        ):
+            yield event
+    
+    return sse_response(events())
+
+# Helper: filtros comunes de /transactions y /transactions/export (sirve para Query y Select)
+def filter_transactions(query, start_date, end_date, category, type, keywords: Optional[List[str]] = None):
+    if start_date:
+        query = query.filter(Transaction.date >= start_date)
+    if end_date:
+        query = query.filter(Transaction.date <= end_date)
+    if category:
+        query = query.filter(Transaction.category == category)
+    if type:
+        query = query.filter(Transaction.type == type)
+    for keyword in keywords or []:
+        escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(Transaction.description.ilike(f"%{escaped}%", escape="\\"))
+    return query
+
+# Helper: cursor opaco de paginación keyset (date, id)
+def encode_cursor(tx_date: date, tx_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{tx_date.isoformat()}|{tx_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        tx_date, tx_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return date.fromisoformat(tx_date), int(tx_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+EXPORT_COLUMNS = ["id", "date", "amount", "description", "account_id", "type", "category"]
+
+def export_batches(stmt, batch_size: int):
+    """Yield row batches through a server-side cursor (sesión propia: vive lo que dure el stream)."""
+    db = SessionLocal()
+    try:
+        # Un export completo puede superar el statement_timeout normal de la API
+        db.execute(text(f"SET LOCAL statement_timeout = {int(settings.EXPORT_STATEMENT_TIMEOUT_MS)}"))
+        result = db.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+def export_ndjson(batches):
+    for rows in batches:
+        yield "".join(
+            json.dumps({
+                "id": r.id, "date": r.date.isoformat(), "amount": float(r.amount),
+                "description": r.description, "account_id": r.account_id,
+                "type": r.type, "category": r.category
+            }, ensure_ascii=False) + "\n"
+            for r in rows
+        ).encode()
+
+def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def export_arrow(batches):
+    import pyarrow as pa
+    schema = pa.schema([
+        ("id", pa.int64()), ("date", pa.date32()), ("amount", pa.decimal128(15, 2)),
+        ("description", pa.string()), ("account_id", pa.string()),
+        ("type", pa.string()), ("category", pa.string())
+    ])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+EXPORT_FORMATS = {
+    "ndjson": (export_ndjson, "application/x-ndjson"),
+    "csv": (export_csv, "text/csv"),
+    "arrow": (export_arrow, "application/vnd.apache.arrow.stream"),
+}
+
 @app.get("/transactions", response_model=List[TransactionResponse])
 def get_transactions(
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     category: Optional[str] = None,
     type: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
+    """List transactions newest first.
+    
+    Use `cursor` (returned in the X-Next-Cursor header) for keyset pagination; `skip`
+    is kept for compatibility but gets slower the deeper the page.
+    """
     try:
-        query = db.query(Transaction)
-        if start_date:
-            query = query.filter(Transaction.date >= start_date)
-        if end_date:
-            query = query.filter(Transaction.date <= end_date)
-        if category:
-            query = query.filter(Transaction.category == category)
-        if type:
-            query = query.filter(Transaction.type == type)
-
-        transactions = query.order_by(desc(Transaction.date)).offset(skip).limit(limit).all()
-        return [TransactionResponse(
-            id=t.id,
-            date=t.date,
-            amount=float(t.amount),
-            description=t.description,
-            account_id=t.account_id,
-            type=t.type,
-            category=t.category
-        ) for t in transactions]
+        query = db.query(
+            Transaction.id, Transaction.date, Transaction.amount, Transaction.description,
+            Transaction.account_id, Transaction.type, Transaction.category
+        )
+        query = filter_transactions(query, start_date, end_date, category, type)
+        if cursor:
+            query = query.filter(tuple_(Transaction.date, Transaction.id) < decode_cursor(cursor))
+        elif skip:
+            query = query.offset(skip)
+
+        rows = query.order_by(desc(Transaction.date), desc(Transaction.id)).limit(limit).all()
+        if len(rows) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].date, rows[-1].id)
+        return [TransactionResponse.model_validate(row, from_attributes=True) for row in rows]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/transactions/export")
+def export_transactions(
+    format: Literal["ndjson", "csv", "arrow"] = "ndjson",
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    category: Optional[str] = None,
+    type: Optional[str] = None
+):
+    """Stream every matching transaction (newest first) in constant memory."""
+    if format == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Arrow export requires pyarrow")
+    
+    stmt = select(*[getattr(Transaction, c) for c in EXPORT_COLUMNS])
+    stmt = filter_transactions(stmt, start_date, end_date, category, type)
+    stmt = stmt.order_by(desc(Transaction.date), desc(Transaction.id))
+    
+    formatter, media_type = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        formatter(export_batches(stmt, settings.EXPORT_BATCH_SIZE)),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="transactions.{format}"'}
+    )
+
 @app.get("/analytics/categories")
-def get_categories(db: Session = Depends(get_db)):
+def get_categories(request: Request, db: Session = Depends(get_db)):
     """Get list of all categories"""
-    try:
+    def compute():
         categories = db.query(Transaction.category).distinct().all()
         return {"categories": [c[0] for c in categories if c[0]]}
+    try:
+        return cached_json_response(request, "categories", db, compute)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
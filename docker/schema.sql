@@ -10,6 +10,7 @@ CREATE TABLE transactions (
     account_id VARCHAR(255) NOT NULL, -- pseudonymized account ID (hashed)
     type VARCHAR(50) NOT NULL, -- inflow or outflow
     category VARCHAR(100), -- transaction category
+    tx_hash VARCHAR(64), -- deterministic content hash, key for idempotent loads (ETL)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -19,7 +20,32 @@ CREATE TABLE pipeline_runs (
     run_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     status VARCHAR(50) NOT NULL, -- success, failed, running
     records_processed INTEGER NOT NULL DEFAULT 0,
-    error_message TEXT
+    error_message TEXT,
+    source VARCHAR(500), -- logical feed loaded by the run
+    watermark DATE -- max transaction date loaded for the source
+);
+
+-- Monthly KPI rollups (month × type × category × account), maintained by the ETL
+-- category NULL is stored as '' so it can be part of the primary key
+CREATE TABLE transaction_monthly_rollups (
+    month DATE NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    category VARCHAR(100) NOT NULL,
+    account_id VARCHAR(255) NOT NULL,
+    tx_count BIGINT NOT NULL,
+    amount_sum DECIMAL(20,2) NOT NULL,
+    abs_amount_sum DECIMAL(20,2) NOT NULL,
+    PRIMARY KEY (month, type, category, account_id)
+);
+
+-- Executive insights generated once per (provider, data version = successful pipeline_runs id)
+CREATE TABLE insights (
+    id SERIAL PRIMARY KEY,
+    provider VARCHAR(50) NOT NULL,
+    data_version INTEGER NOT NULL,
+    insight TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (provider, data_version)
 );
 
 -- Create indexes for performance
@@ -39,12 +65,21 @@ CREATE INDEX idx_transactions_category ON transactions (category);
 CREATE INDEX idx_transactions_date_type ON transactions (date DESC, type);
 CREATE INDEX idx_transactions_date_category ON transactions (date DESC, category);
 
+-- Keyset pagination / export order for /transactions
+CREATE INDEX idx_transactions_date_id ON transactions (date DESC, id DESC);
+
+-- Unique content hash so re-runs and overlapping files never duplicate rows
+CREATE UNIQUE INDEX idx_transactions_tx_hash ON transactions (tx_hash);
+
 -- Index on pipeline_runs run_date for chronological ordering
 CREATE INDEX idx_pipeline_runs_run_date ON pipeline_runs (run_date DESC);
 
 -- Index on pipeline_runs status for status-based queries
 CREATE INDEX idx_pipeline_runs_status ON pipeline_runs (status);
 
+-- Index on pipeline_runs source for per-source watermark lookups
+CREATE INDEX idx_pipeline_runs_source ON pipeline_runs (source, run_date DESC);
+
 -- Insert sample configuration (opcional, para testing)
 -- Este insert se puede usar para verificar que el schema funciona
 INSERT INTO pipeline_runs (status, records_processed) VALUES ('initialized', 0);
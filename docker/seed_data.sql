@@ -137,6 +137,18 @@ INSERT INTO pipeline_runs (run_date, status, records_processed, error_message) V
 (NOW() - INTERVAL '1 day', 'success', 95, NULL),
 (NOW(), 'success', 95, NULL);
 
+-- ============================================================================
+-- Rollups mensuales para los KPIs (el ETL los mantiene; aquí se reconstruyen)
+-- ============================================================================
+
+TRUNCATE TABLE transaction_monthly_rollups;
+INSERT INTO transaction_monthly_rollups
+    (month, type, category, account_id, tx_count, amount_sum, abs_amount_sum)
+SELECT date_trunc('month', date)::date, type, COALESCE(category, ''), account_id,
+       count(*), sum(amount), sum(abs(amount))
+FROM transactions
+GROUP BY 1, 2, 3, 4;
+
 -- ============================================================================
 -- Resumen de datos insertados
 -- ============================================================================
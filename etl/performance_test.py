@@ -42,11 +42,11 @@ logging.info(f"Normalization time: {norm_time:.2f} seconds")
 
 # Pseudonymize
 start = time.time()
+# Hash each distinct account once, then map back onto the rows
+accounts = df_norm['account_id_raw'].cast(pl.Utf8).unique()
+hashes = pl.Series([hashlib.sha256(a.encode()).hexdigest() for a in accounts], dtype=pl.Utf8)
 df_pseudo = df_norm.with_columns(
-    pl.col('account_id_raw').map_elements(
-        lambda x: hashlib.sha256(str(x).encode()).hexdigest(),
-        return_dtype=pl.Utf8
-    ).alias('account_id')
+    pl.col('account_id_raw').cast(pl.Utf8).replace_strict(accounts, hashes, return_dtype=pl.Utf8).alias('account_id')
 )
 pseudo_time = time.time() - start
 logging.info(f"Pseudonymization time: {pseudo_time:.2f} seconds")
@@ -72,8 +72,12 @@ logging.info(f"Classification time: {class_time:.2f} seconds")
 # Embeddings
 start = time.time()
 model = SentenceTransformer('all-MiniLM-L6-v2')
-texts = (df_class['description'].cast(pl.Utf8) + ' ' + df_class['category'].cast(pl.Utf8)).to_list()
-embeddings = model.encode(texts)
+texts = df_class['description'].cast(pl.Utf8) + ' ' + df_class['category'].cast(pl.Utf8)
+# Encode each distinct text once and gather the vectors back onto the rows
+unique_texts = texts.unique(maintain_order=True)
+unique_embeddings = model.encode(unique_texts.to_list())
+positions = texts.replace_strict(unique_texts, pl.int_range(len(unique_texts), eager=True), return_dtype=pl.UInt32)
+embeddings = unique_embeddings[positions.to_numpy()]
 df_embed = df_class.with_columns(
     pl.Series('embedding', embeddings.tolist(), dtype=pl.List(pl.Float32))
 )